@@ -1,56 +1,311 @@
+import collections
+import dataclasses
+import functools
+import json
 import os
-import re
+import tempfile
 
 import sublime
 import sublime_plugin
 
 
+class HeaderGuardTable(dict):
+    """
+    Translation table which maps every character other than 0-9 and A-Z to an underscore. Entries
+    are populated lazily as new characters are encountered.
+    """
+
+    def __missing__(self, ordinal):
+        character = chr(ordinal)
+
+        if not (('0' <= character <= '9') or ('A' <= character <= 'Z')):
+            character = '_'
+
+        self[ordinal] = character
+        return character
+
+
+_HEADER_GUARD_TABLE = HeaderGuardTable()
+_WINDOW_INFO = {}
+
+
+@dataclasses.dataclass
+class WindowInfo(object):
+    """
+    Snapshot of the project information of a window.
+    """
+    project_file: str
+    folders: tuple
+    folders_sorted: tuple
+    settings: dict
+
+
+def get_window_info(window):
+    """
+    Load the project information of a window. The information is cached until the window's project
+    is reloaded or saved, or until its project file or folders change (folders may be added to or
+    removed from a window without a project being saved, which raises no event).
+    """
+    window_id = window.id()
+    project_file = window.project_file_name()
+    folders = tuple(window.folders())
+    info = _WINDOW_INFO.get(window_id)
+
+    if info and (info.project_file == project_file) and (info.folders == folders):
+        return info
+
+    project_data = window.project_data() or {}
+    settings = dict((project_data.get('settings') or {}).get('copy-paths') or {})
+
+    # Sort the prefixes to strip from longest to shortest so that the first match is the longest.
+    prefixes = settings.get('c_family_includes_strip_prefixes') or []
+    settings['c_family_includes_strip_prefixes'] = sorted(prefixes, key=len, reverse=True)
+
+    info = WindowInfo(project_file, folders, tuple(sorted(folders, key=len)), settings)
+    _WINDOW_INFO[window_id] = info
+
+    return info
+
+
+def get_project_settings(window):
+    """
+    Load the copy-paths project settings of a window.
+    """
+    return get_window_info(window).settings
+
+
+def get_project_folders(window):
+    """
+    Load the folders of a window, sorted from shortest to longest path.
+    """
+    return get_window_info(window).folders_sorted
+
+
 def get_project_setting(setting_key, default):
     """
     Load a project setting from the active window.
     """
-    project_data = sublime.active_window().project_data()
-    if not project_data or ('settings' not in project_data):
-        return default
+    settings = get_project_settings(sublime.active_window())
+    return settings.get(setting_key, default)
 
-    settings = project_data['settings']
-    if 'copy-paths' not in project_data['settings']:
-        return default
 
-    settings = settings['copy-paths']
+def invalidate_window_cache(window_id):
+    """
+    Discard the cached project information of a window.
+    """
+    _WINDOW_INFO.pop(window_id, None)
+
+
+class ProjectListener(sublime_plugin.EventListener):
+    """
+    Listener to keep cached project information fresh when a window's project changes, and to drop
+    cached information about windows as they are closed.
+    """
+
+    def on_load_project(self, window):
+        invalidate_window_cache(window.id())
+
+    def on_post_save_project(self, window):
+        invalidate_window_cache(window.id())
+
+    def on_pre_close_window(self, window):
+        invalidate_window_cache(window.id())
+        save_relative_path_cache(asynchronous=True)
+
+    def on_post_save(self, view):
+        # Editing the project file directly (e.g. via Project > Edit Project) does not raise a
+        # project event, so watch for the project file itself being saved.
+        window = view.window()
+        project_file = window.project_file_name() if window else None
+
+        if project_file and (view.file_name() == project_file):
+            invalidate_window_cache(window.id())
+
+
+def find_relative_path(file_path, project_paths):
+    """
+    Determine the path of a file relative to its project's root directory. Returns a tuple of the
+    relative path and the project path, both of which are None if the file is not in a project. The
+    project paths must be sorted from shortest to longest path.
+    """
+    # This file may appear under multiple projects (e.g. if a subpath of an existing project was
+    # added as a folder). Pick the project with the shortest path length to get the top-most project
+    # path.
+    project_path = next((p for p in project_paths if file_path.startswith(p)), None)
+
+    if project_path is None:
+        return (None, None)
 
-    if setting_key not in settings:
-        return default
+    remainder = file_path[len(project_path):]
 
-    return settings[setting_key]
+    # Both paths come from Sublime and are normally already absolute and normalized, so the relative
+    # path may be sliced off directly rather than paying for os.path.relpath's normalization. Fall
+    # back to os.path.relpath otherwise, or if the project path is only a partial prefix of a path
+    # component (e.g. "/foo/bar" and "/foo/barbaz/file.txt").
+    is_absolute = os.path.isabs(file_path) and os.path.isabs(project_path)
+    is_component = project_path.endswith(os.sep) or (remainder[:1] in (os.sep, str()))
 
+    if is_absolute and is_component:
+        relative_path = remainder.lstrip(os.sep) or os.curdir
+    else:
+        relative_path = os.path.relpath(file_path, project_path)
 
-class RelativePath(object):
+    return (relative_path, project_path)
+
+
+class RelativePathCache(object):
     """
-    Class to determine and store the path of the current file relative to its project's root
-    directory.
+    Class to memoize relative path resolution, keyed by the file path and its window's project
+    paths. The cache may be saved to and loaded from disk so that it survives restarts. Entries for
+    files which no longer exist are not checked for; they age out as the cache fills.
     """
+    VERSION = 1
+    MAX_SIZE = 512
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.entries = collections.OrderedDict()
+
+    def __call__(self, file_path, project_paths):
+        key = (file_path, project_paths)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = self.resolver(file_path, project_paths)
+
+            if len(self.entries) > self.MAX_SIZE:
+                self.entries.popitem(last=False)
+
+        return self.entries[key]
+
+    def merge(self, entries):
+        # Paths resolved since the plugin loaded are kept, and merged entries are treated as older.
+        for (key, value) in reversed(entries):
+            if key not in self.entries:
+                self.entries[key] = value
+                self.entries.move_to_end(key, last=False)
+
+        while len(self.entries) > self.MAX_SIZE:
+            self.entries.popitem(last=False)
+
+    def dump(self):
+        entries = [[f, list(p), r, pp] for ((f, p), (r, pp)) in self.entries.items()]
+        return {'version': self.VERSION, 'entries': entries}
+
+    @classmethod
+    def read(cls, cache_file):
+        try:
+            with open(cache_file, 'r') as cache:
+                data = json.load(cache)
+        except (OSError, ValueError):
+            return []
+
+        if not isinstance(data, dict) or (data.get('version') != cls.VERSION):
+            return []
+
+        entries = data.get('entries')
+
+        if not isinstance(entries, list):
+            return []
+
+        return [((e[0], tuple(e[1])), (e[2], e[3])) for e in entries if cls.is_valid_entry(e)]
 
-    def __init__(self):
-        self.project_path = None
-        self.relative_path = None
+    @staticmethod
+    def is_valid_entry(entry):
+        def is_path(path, optional=False):
+            return isinstance(path, str) or (optional and (path is None))
 
-    def __call__(self, view):
-        if not self.relative_path:
-            project_paths = view.window().folders()
-            file_path = view.file_name() or str()
+        if not isinstance(entry, list) or (len(entry) != 4):
+            return False
 
-            # This file may appear under multiple projects (e.g. if a subpath of an existing project
-            # was added as a folder). Pick the project with the shortest path length to get the
-            # top-most project path.
-            candidates = [p for p in project_paths if file_path.startswith(p)]
+        (file_path, project_paths, relative_path, project_path) = entry
 
-            if candidates:
-                self.project_path = min(candidates, key=len)
-                self.relative_path = os.path.relpath(
-                    file_path, self.project_path)
+        return (is_path(file_path) and isinstance(project_paths, list) and
+                all(is_path(p) for p in project_paths) and
+                is_path(relative_path, optional=True) and is_path(project_path, optional=True))
 
-        return (self.relative_path, self.project_path)
+    @staticmethod
+    def write(cache_file, data):
+        # Write to a temporary file which then replaces the cache file, so that overlapping saves
+        # cannot leave a truncated cache file behind.
+        directory = os.path.dirname(cache_file)
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            (handle, temp_file) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(handle, 'w') as cache:
+                json.dump(data, cache)
+
+            os.replace(temp_file, cache_file)
+        except OSError:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+
+resolve_relative_path = RelativePathCache(find_relative_path)
+
+
+def relative_path_cache_file():
+    """
+    Determine the path of the file in which resolved relative paths are persisted.
+    """
+    return os.path.join(sublime.cache_path(), 'sublime-copy-paths', 'relpath.json')
+
+
+def load_relative_path_cache():
+    """
+    Read the persisted relative paths from disk. This runs on Sublime's async thread, so the entries
+    are merged into the cache on the main thread, where the cache is otherwise used.
+    """
+    entries = RelativePathCache.read(relative_path_cache_file())
+
+    if entries:
+        sublime.set_timeout(lambda: resolve_relative_path.merge(entries))
+
+
+def save_relative_path_cache(asynchronous=False):
+    """
+    Persist the resolved relative paths to disk. The cache is snapshotted on the calling thread, and
+    optionally written from Sublime's async thread.
+    """
+    (cache_file, data) = (relative_path_cache_file(), resolve_relative_path.dump())
+
+    if asynchronous:
+        sublime.set_timeout_async(lambda: RelativePathCache.write(cache_file, data))
+    else:
+        RelativePathCache.write(cache_file, data)
+
+
+def plugin_loaded():
+    sublime.set_timeout_async(load_relative_path_cache)
+
+
+def plugin_unloaded():
+    save_relative_path_cache()
+
+
+@functools.lru_cache(maxsize=64)
+def is_syntax_supported(syntax, languages):
+    """
+    Determine whether a syntax definition is for one of the given languages.
+    """
+    (syntax, _) = os.path.splitext(syntax)
+    return any(syntax.endswith(lang) for lang in languages)
+
+
+def copy_to_clipboard(text, message):
+    """
+    Copy text to the clipboard and announce it in the status bar.
+    """
+    sublime.set_clipboard(text)
+    sublime.status_message(message)
 
 
 class RelativePathCommand(sublime_plugin.TextCommand):
@@ -58,15 +313,15 @@ class RelativePathCommand(sublime_plugin.TextCommand):
     Base class for commands which need relative path information.
     """
 
-    def __init__(self, *args, **kwargs):
-        super(RelativePathCommand, self).__init__(*args, **kwargs)
-        self.relative_path = RelativePath()
+    def relative_path(self):
+        window = self.view.window()
+        project_paths = get_project_folders(window) if window else tuple()
 
-    def is_enabled_for_languages(self, languages):
-        (syntax, _) = os.path.splitext(self.view.settings().get('syntax'))
-        supported = any(syntax.endswith(lang) for lang in languages)
+        return resolve_relative_path(self.view.file_name() or str(), project_paths)
 
-        return supported and all(self.relative_path(self.view))
+    def is_enabled_for_languages(self, languages):
+        supported = is_syntax_supported(self.view.settings().get('syntax'), languages)
+        return supported and all(self.relative_path())
 
 
 class CFamilyCommand(RelativePathCommand):
@@ -77,7 +332,7 @@ class CFamilyCommand(RelativePathCommand):
     HEADERS = ('.h', '.hh', '.hpp')
 
     def to_header_file(self):
-        (relative_path, project_path) = self.relative_path(self.view)
+        (relative_path, project_path) = self.relative_path()
         (path, ext) = os.path.splitext(relative_path)
 
         if ext not in self.HEADERS:
@@ -91,21 +346,22 @@ class CFamilyCommand(RelativePathCommand):
         return relative_path.replace(os.path.sep, '/')
 
     def to_include_statement(self, include_text):
-        use_brackets = get_project_setting('c_family_includes_use_brackets', False)
-        prefixes = get_project_setting('c_family_includes_strip_prefixes', [])
+        settings = get_project_settings(sublime.active_window())
+        use_brackets = settings.get('c_family_includes_use_brackets', False)
+        prefixes = settings.get('c_family_includes_strip_prefixes', [])
 
         opening_character = '<' if use_brackets else '"'
         closing_character = '>' if use_brackets else '"'
         header_file = self.to_header_file()
 
-        for prefix in [p for p in prefixes if header_file.startswith(p)]:
-            header_file = header_file.replace(prefix, '')
+        prefix = next((p for p in prefixes if header_file.startswith(p)), None)
+
+        if prefix is not None:
+            header_file = header_file[len(prefix):]
 
             if header_file.startswith('/'):
                 header_file = header_file[1:]
 
-            break
-
         return f'#{include_text} {opening_character}{header_file}{closing_character}'
 
     def is_enabled(self):
@@ -119,15 +375,17 @@ class JavaFamilyCommand(RelativePathCommand):
     LANGUAGES = ('Java', )
 
     def to_java_path(self):
-        (relative_path, _) = self.relative_path(self.view)
+        (relative_path, _) = self.relative_path()
 
         java_path = os.path.splitext(relative_path)[0]
         java_path = java_path.replace(os.path.sep, '.')
 
-        if '.com.' in java_path:
-            java_path = java_path[java_path.index('.com.') + 1:]
-        elif '.org.' in java_path:
-            java_path = java_path[java_path.index('.org.') + 1:]
+        for marker in ('.com.', '.org.'):
+            (_, separator, package) = java_path.partition(marker)
+
+            if separator:
+                java_path = marker[1:] + package
+                break
 
         return java_path
 
@@ -135,43 +393,72 @@ class JavaFamilyCommand(RelativePathCommand):
         return self.is_enabled_for_languages(self.LANGUAGES)
 
 
-class CopyFilePathCommand(sublime_plugin.TextCommand):
+class FileCommand(sublime_plugin.TextCommand):
     """
-    Command to copy the path of the current file.
+    Base class for commands which need the path of the current file. The path is cached when the
+    command's enabled state is checked, along with its name and directory once they are needed.
     """
 
-    def run(self, edit):
-        sublime.set_clipboard(self.view.file_name())
-        sublime.status_message('Copied file path')
+    def __init__(self, *args, **kwargs):
+        super(FileCommand, self).__init__(*args, **kwargs)
+        self.cached_path = None
+        self.cached_basename = None
+        self.cached_dirname = None
+
+    def cache_file_path(self):
+        file_path = self.view.file_name()
+
+        if file_path != self.cached_path:
+            self.cached_path = file_path
+            self.cached_basename = None
+            self.cached_dirname = None
+
+        return file_path
+
+    def file_path(self):
+        return self.cached_path or self.cache_file_path()
+
+    def file_basename(self):
+        if self.cached_basename is None:
+            self.cached_basename = os.path.basename(self.file_path())
+
+        return self.cached_basename
+
+    def file_dirname(self):
+        if self.cached_dirname is None:
+            self.cached_dirname = os.path.dirname(self.file_path())
+
+        return self.cached_dirname
 
     def is_enabled(self):
-        return bool(self.view.file_name())
+        return bool(self.cache_file_path())
 
 
-class CopyFileNameCommand(sublime_plugin.TextCommand):
+class CopyFilePathCommand(FileCommand):
     """
-    Command to copy the name of the current file.
+    Command to copy the path of the current file.
     """
 
     def run(self, edit):
-        sublime.set_clipboard(os.path.basename(self.view.file_name()))
-        sublime.status_message('Copied file name')
+        copy_to_clipboard(self.file_path(), 'Copied file path')
 
-    def is_enabled(self):
-        return bool(self.view.file_name())
+
+class CopyFileNameCommand(FileCommand):
+    """
+    Command to copy the name of the current file.
+    """
+
+    def run(self, edit):
+        copy_to_clipboard(self.file_basename(), 'Copied file name')
 
 
-class CopyFileDirectoryCommand(sublime_plugin.TextCommand):
+class CopyFileDirectoryCommand(FileCommand):
     """
     Command to copy the directory of the current file.
     """
 
     def run(self, edit):
-        sublime.set_clipboard(os.path.dirname(self.view.file_name()))
-        sublime.status_message('Copied file directory')
-
-    def is_enabled(self):
-        return bool(self.view.file_name())
+        copy_to_clipboard(self.file_dirname(), 'Copied file directory')
 
 
 class CopyFilePathRelativeToProjectCommand(RelativePathCommand):
@@ -180,10 +467,9 @@ class CopyFilePathRelativeToProjectCommand(RelativePathCommand):
     """
 
     def run(self, edit):
-        (relative_path, _) = self.relative_path(self.view)
+        (relative_path, _) = self.relative_path()
 
-        sublime.set_clipboard(relative_path)
-        sublime.status_message('Copied relative file')
+        copy_to_clipboard(relative_path, 'Copied relative file')
 
 
 class CopyFileDirectoryRelativeToProjectCommand(RelativePathCommand):
@@ -192,10 +478,9 @@ class CopyFileDirectoryRelativeToProjectCommand(RelativePathCommand):
     """
 
     def run(self, edit):
-        (relative_path, _) = self.relative_path(self.view)
+        (relative_path, _) = self.relative_path()
 
-        sublime.set_clipboard(os.path.dirname(relative_path))
-        sublime.status_message('Copied relative directory')
+        copy_to_clipboard(os.path.dirname(relative_path), 'Copied relative directory')
 
 
 class CopyFilePathAsIncludeMacroCommand(CFamilyCommand):
@@ -207,8 +492,7 @@ class CopyFilePathAsIncludeMacroCommand(CFamilyCommand):
     def run(self, edit):
         include = self.to_include_statement('include')
 
-        sublime.set_clipboard(include)
-        sublime.status_message('Copied include')
+        copy_to_clipboard(include, 'Copied include')
 
 
 class CopyFilePathAsImportMacroCommand(CFamilyCommand):
@@ -220,8 +504,7 @@ class CopyFilePathAsImportMacroCommand(CFamilyCommand):
     def run(self, edit):
         include = self.to_include_statement('import')
 
-        sublime.set_clipboard(include)
-        sublime.status_message('Copied import')
+        copy_to_clipboard(include, 'Copied import')
 
 
 class CopyFilePathAsHeaderGuardCommand(CFamilyCommand):
@@ -231,11 +514,12 @@ class CopyFilePathAsHeaderGuardCommand(CFamilyCommand):
     """
 
     def run(self, edit):
-        header_file = self.to_header_file().upper() + '_'
-        header_file = re.sub('[^0-9A-Z]+', '_', header_file)
+        header_file = (self.to_header_file().upper() + '_').translate(_HEADER_GUARD_TABLE)
+
+        while '__' in header_file:
+            header_file = header_file.replace('__', '_')
 
-        sublime.set_clipboard(header_file)
-        sublime.status_message('Copied include guard')
+        copy_to_clipboard(header_file, 'Copied include guard')
 
 
 class CopyFilePathAsImportStatementCommand(JavaFamilyCommand):
@@ -248,8 +532,7 @@ class CopyFilePathAsImportStatementCommand(JavaFamilyCommand):
         java_path = self.to_java_path()
         include = 'import %s;' % (java_path)
 
-        sublime.set_clipboard(include)
-        sublime.status_message('Copied import')
+        copy_to_clipboard(include, 'Copied import')
 
 
 class CopyFileDirectoryAsPackageStatementCommand(JavaFamilyCommand):
@@ -259,8 +542,7 @@ class CopyFileDirectoryAsPackageStatementCommand(JavaFamilyCommand):
     """
 
     def run(self, edit):
-        java_path = '.'.join(self.to_java_path().split('.')[: -1])
+        java_path = self.to_java_path().rpartition('.')[0]
         include = 'package %s;' % (java_path)
 
-        sublime.set_clipboard(include)
-        sublime.status_message('Copied package')
+        copy_to_clipboard(include, 'Copied package')